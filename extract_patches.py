@@ -1,35 +1,231 @@
 #!/usr/bin/env python3
 
+import argparse
+import io
+import multiprocessing
+import os
 import random
 import sys
+import tarfile
+import time
 
-from pyvips import Image, Region
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Tuple
+
+# Patches are extracted by a pool of worker processes, each running a
+# single-threaded libvips: for many small independent jobs this scales better
+# than one multi-threaded vips instance.  Must be set before libvips is loaded.
+os.environ["VIPS_CONCURRENCY"] = "1"
+
+import numpy as np  # noqa: E402
+
+from pyvips import Image, Region, at_least_libvips  # noqa: E402
+from turbojpeg import TurboJPEG, TJPF_GRAY, TJPF_RGB, TJSAMP_444, TJSAMP_GRAY  # noqa: E402
 
 n_patches = 100
 patch_size = 512
 out_quality = 90
+# maximum width and height of the area read with a single Region.fetch
+max_fetch_size = 4096
+# Decoded pixels are cached in tiles of this size, so that patches close to
+# each other don't decode the same part of the image twice
+cache_tile_size = 512
+cache_max_tiles = 64
+
+# TurboJPEG (pixel format, chroma subsampling) by number of image bands.
+# libvips turns chroma subsampling off for Q >= 90, and so do we.
+jpeg_formats = {
+    1: (TJPF_GRAY, TJSAMP_GRAY),
+    3: (TJPF_RGB, TJSAMP_444),
+}
+
+# per-process state, initialized by init_worker
+image = None
+region = None
+jpeg = None
+encoder = None
+out_format = None
+scratch = None
 
 
-def main(filename: str):
+def open_image(filename: str) -> Image:
     image = Image.new_from_file(filename, access="random")
+    # drop the alpha (e.g., from openslide) once here, so that it is
+    # neither cached nor fetched with every patch
+    if image.hasalpha():
+        image = image[:-1]
+    return image
+
+
+def init_worker(filename: str, patch_format: str) -> None:
+    global image, region, jpeg, encoder, out_format, scratch
+    image = open_image(filename) \
+        .tilecache(tile_width=cache_tile_size, tile_height=cache_tile_size, max_tiles=cache_max_tiles)
+    region = Region.new(image)
+    # only load libturbojpeg if we need it
+    if patch_format == "jpg":
+        jpeg = TurboJPEG()
+    # The encoders release the GIL, so a separate thread can encode a
+    # group of patches while the next one is fetched.  The Region is only
+    # used from the worker's main thread, since it isn't thread-safe.
+    encoder = ThreadPoolExecutor(max_workers=1)
+    out_format = patch_format
+    # contiguous buffer that each patch is copied into before encoding;
+    # only used by the (single) encoder thread
+    scratch = np.empty((patch_size, patch_size, image.bands), dtype=np.uint8)
+
+
+def bounding_box(patches: List[Tuple[int, int, int]]) -> Tuple[int, int, int, int]:
+    left = min(x for x, _, _ in patches)
+    top = min(y for _, y, _ in patches)
+    width = max(x for x, _, _ in patches) + patch_size - left
+    height = max(y for _, y, _ in patches) + patch_size - top
+    return left, top, width, height
+
+
+def group_patches(coords: List[Tuple[int, int, int]]) -> List[List[Tuple[int, int, int]]]:
+    """
+    Group spatially close patches so that each group can be read with a
+    single Region.fetch.  Patches are only grouped while the bounding box
+    of the group covers no more pixels than the patches themselves would
+    if fetched one by one, so grouping never increases the decoding work.
+    """
+    ordered = sorted(coords, key=lambda c: (c[1] // max_fetch_size, c[0] // max_fetch_size, c[1], c[0]))
+    groups = []
+    for c in ordered:
+        for group in groups:
+            _, _, width, height = bounding_box(group + [c])
+            if width <= max_fetch_size and height <= max_fetch_size and \
+                    width * height <= (len(group) + 1) * patch_size * patch_size:
+                group.append(c)
+                break
+        else:
+            groups.append([c])
+
+    # visit the groups in tile order, so that neighbouring groups can share cached tiles
+    def tile_index(group):
+        left, top, _, _ = bounding_box(group)
+        return top // cache_tile_size, left // cache_tile_size
+    return sorted(groups, key=tile_index)
+
+
+def encode_jpeg(patch_array: np.ndarray) -> bytes:
+    # encode the fetched pixels directly with libjpeg-turbo, without
+    # wrapping them in a new vips image
+    pixel_format, subsample = jpeg_formats[patch_array.shape[2]]
+    return jpeg.encode(patch_array, quality=out_quality, pixel_format=pixel_format, jpeg_subsample=subsample)
+
+
+def encode_webp(patch_array: np.ndarray) -> bytes:
+    patch_image = Image.new_from_memory(patch_array, patch_size, patch_size, image.bands, "uchar")
+    return patch_image.webpsave_buffer(Q=out_quality, effort=4)
+
+
+# patch encoder by output format
+patch_encoders = {
+    "jpg": encode_jpeg,
+    "webp": encode_webp,
+}
+
+
+def encode_patches(pixels: np.ndarray, left: int, top: int,
+                   patches: List[Tuple[int, int, int]]) -> List[Tuple[str, bytes]]:
+    """
+    Returns a list of (file name, encoded data) tuples, one per patch.
+    """
+    encode = patch_encoders[out_format]
+    encoded = []
+    for xcoord, ycoord, image_num in patches:
+        # Both encoders need contiguous pixels.  Copy the patch into the
+        # preallocated scratch buffer rather than having them allocate a
+        # new array for every patch.
+        np.copyto(scratch, pixels[ycoord - top:ycoord - top + patch_size, xcoord - left:xcoord - left + patch_size])
+        encoded.append(("{:03d}_{}_{}.{}".format(image_num, xcoord, ycoord, out_format), encode(scratch)))
+    return encoded
+
+
+def extract_patches(groups: List[List[Tuple[int, int, int]]]) -> List[Tuple[str, bytes]]:
+    """
+    Fetch each group of patches and hand it to the encoder thread.
+    Returns a list of (file name, encoded data) tuples, one per patch.
+    """
+    futures = []
+    for patches in groups:
+        left, top, width, height = bounding_box(patches)
+        pixels = np.frombuffer(region.fetch(left, top, width, height), dtype=np.uint8) \
+            .reshape(height, width, image.bands)
+        futures.append(encoder.submit(encode_patches, pixels, left, top, patches))
+    return [encoded for f in futures for encoded in f.result()]
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Extract random patches from an image into a tar archive of image files")
+
+    parser.add_argument("image", metavar="SOURCE")
+    parser.add_argument('-o', '--output', type=Path, default=Path("patches.tar"),
+                        help="Output tar archive (default: %(default)s)")
+    parser.add_argument('-f', '--format', choices=tuple(patch_encoders), default="jpg",
+                        help="Patch image format (default: %(default)s)")
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    opts = parse_args(args)
+    filename = opts.image
+
+    image = open_image(filename)
     print("Opened image file", filename)
     print("Image metadata:")
     for field in image.get_fields():
         print(f"{field}: {image.get(field)}")
 
-    region = Region.new(image)
+    if not at_least_libvips(8, 15):
+        # older versions decompress TIFF tiles while holding a per-file lock
+        print("Warning: libvips < 8.15 can't decode TIFF tiles in parallel; "
+              "patch extraction will be slower", file=sys.stderr)
+
+    if image.format != "uchar" or image.bands not in jpeg_formats:
+        raise ValueError(f"Can't write patches from a {image.bands}-band {image.format} image")
+
+    coords = [(random.randint(0, image.width - patch_size),
+               random.randint(0, image.height - patch_size),
+               i) for i in range(n_patches)]
 
-    def extract_and_write_patch(xcoord: int, ycoord: int, image_num: int):
-        patch = region.fetch(xcoord, ycoord, patch_size, patch_size)
-        patch_image = Image.new_from_memory(patch, patch_size, patch_size, image.bands, image.format)
-        out_filename = "{:03d}_{}_{}.jpg".format(image_num, xcoord, ycoord)
-        patch_image.write_to_file(out_filename, Q=out_quality)
+    groups = group_patches(coords)
+    # Each worker re-imports the modules and reopens the image, so don't
+    # start more of them than there are groups to process
+    n_workers = min(os.cpu_count() or 1, len(groups))
 
-    for i in range(n_patches):
-        x = random.randint(0, image.width - patch_size)
-        y = random.randint(0, image.height - patch_size)
-        extract_and_write_patch(x, y, i)
+    # The patches are streamed into a single archive: one sequential write
+    # instead of a create/close cycle per file, which is slow on network
+    # file systems.
+    # spawn rather than fork: libvips isn't safe to use in a forked child
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_worker, initargs=(filename, opts.format)) as executor:
+        # hand each worker a contiguous run of groups, to make use of its
+        # tile cache and to overlap fetching and encoding within the run
+        run_length = -(-len(groups) // n_workers)
+        runs = [groups[i:i + run_length] for i in range(0, len(groups), run_length)]
+        results = executor.map(extract_patches, runs)
+        try:
+            with tarfile.open(opts.output, "w|") as tar:
+                for encoded in results:
+                    for name, buf in encoded:
+                        info = tarfile.TarInfo(name)
+                        info.size = len(buf)
+                        info.mtime = time.time()
+                        tar.addfile(info, io.BytesIO(buf))
+        except BaseException:
+            # errors in the workers are raised while we're writing: don't
+            # leave an empty or partial archive behind
+            opts.output.unlink(missing_ok=True)
+            raise
+    print("Wrote", n_patches, "patches to", opts.output)
 
 
 if __name__ == "__main__":
-    main(sys.argv[1])
+    main(sys.argv[1:])